@@ -1,13 +1,16 @@
 import os
 import sys
-import glob
+import json
 import time
 import math
 import shutil
+import hashlib
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from general_utils import utils
 from md_utils import data
 from md_utils.simulation import gmx_utils
+from md_utils.utils import Logger
 
 
 def initialize(args):
@@ -36,6 +39,28 @@ def initialize(args):
         default=3,
         help='Number of replicates for production simulations. The default is 3.'
     )
+    parser.add_argument(
+        '--ntmpi',
+        type=int,
+        help='Number of thread-MPI ranks to pass to gmx mdrun (-ntmpi). If not specified, GROMACS decides.'
+    )
+    parser.add_argument(
+        '--ntomp',
+        type=int,
+        help='Number of OpenMP threads per rank to pass to gmx mdrun (-ntomp). If not specified, the value of \
+            the OMP_NUM_THREADS environment variable is used when set; otherwise GROMACS decides.'
+    )
+    parser.add_argument(
+        '--pin',
+        type=str,
+        choices=['on', 'off', 'auto'],
+        help='Thread pinning setting to pass to gmx mdrun (-pin). The default is on when -ntomp is in effect.'
+    )
+    parser.add_argument(
+        '--gpu_id',
+        type=str,
+        help='GPU ID(s) to pass to gmx mdrun (-gpu_id).'
+    )
     parser.add_argument(
         '-l',
         '--log',
@@ -48,17 +73,150 @@ def initialize(args):
     return args_parse
 
 
+PREP_CACHE_FILE = '.prep_cache.json'
+
+
+def _sha256(path):
+    """
+    Compute the SHA-256 digest of a file, reading it in 1 MiB chunks.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file to hash.
+
+    Returns
+    -------
+    digest : str
+        The hexadecimal SHA-256 digest of the file content.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _output_fingerprint(path):
+    """
+    Fingerprint a produced output file by its size and modification time.
+
+    Stored alongside a cache entry and verified on a cache hit, so that a stale
+    entry is not reused when the file on disk was produced from different inputs
+    (e.g. after alternating runs with different systems in the same directory).
+
+    Parameters
+    ----------
+    path : str
+        Path to the output file.
+
+    Returns
+    -------
+    fingerprint : list
+        The file's size in bytes and its modification time.
+    """
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime]
+
+
+def _load_prep_cache(key):
+    """
+    Look up cached preparation results for the given input fingerprint.
+
+    Parameters
+    ----------
+    key : str
+        The input fingerprint, as built in :func:`main`.
+
+    Returns
+    -------
+    entry : dict or None
+        The cached entry (with keys :code:`box_volume` and :code:`total_charge`),
+        or None if there is no usable cache for the key.
+    """
+    try:
+        with open(PREP_CACHE_FILE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return cache.get(key)
+
+
+def _save_prep_cache(key, entry):
+    """
+    Store preparation results for the given input fingerprint.
+
+    The cache file is replaced atomically via os.replace so a concurrent or
+    interrupted run cannot leave a truncated cache behind.
+
+    Parameters
+    ----------
+    key : str
+        The input fingerprint, as built in :func:`main`.
+    entry : dict
+        The results to cache (keys :code:`box_volume` and :code:`total_charge`).
+    """
+    try:
+        with open(PREP_CACHE_FILE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    cache[key] = entry
+    tmp_file = PREP_CACHE_FILE + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp_file, PREP_CACHE_FILE)
+
+
+def _stage_file(src, dst):
+    """
+    Stage one input file into the topology directory.
+
+    For files that are only read by the downstream gmx commands, a hardlink is
+    attempted first. The TOP file is always copied, since gmx solvate and gmx
+    genion rewrite the topology in place through -p and a hardlink would expose
+    the user's original file to that. Copies go through os.sendfile to avoid
+    routing the bytes through userspace, with shutil.copy as the last resort.
+
+    Parameters
+    ----------
+    src : str
+        Path to the source file.
+    dst : str
+        Path to the destination file.
+    """
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    if not dst.endswith('.top'):
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    try:
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            size = os.fstat(s.fileno()).st_size
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(d.fileno(), s.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+    except (AttributeError, OSError):
+        shutil.copy(src, dst)
+
+
 def main():
     t1 = time.time()
     args = initialize(sys.argv[1:])
-    sys.stdout = utils.Logger(args.log)
-    sys.stderr = utils.Logger(args.log)
+    sys.stdout = Logger(args.log, sys.__stdout__)
+    sys.stderr = Logger(args.log, sys.__stderr__)
 
     print(f"\nCommand line: {' '.join(sys.argv)}")
     print(f"Current working directory: {os.getcwd()}")
 
-    # Test GROMACS installation
-    gmx_utils.run_gmx_cmd(['gmx', '--version'], print_output=False)
+    # Test GROMACS installation (skipped if already checked in this environment)
+    gmx_utils.ensure_gmx()
 
     # Step up directories and files
     mdp_dir = args.mdp_dir if args.mdp_dir else data.mdp_dir
@@ -69,33 +227,66 @@ def main():
     os.makedirs(os.path.join('equil', 'NPT'), exist_ok=True)
 
     dst_topology = 'topology'
-    for filename in os.listdir(args.input_dir):
-        # Copy files from input_preparation/gmx_inputs to topology
-        shutil.copy(os.path.join(args.input_dir, filename), os.path.join(dst_topology, filename))
-
-    gro_list = glob.glob(os.path.join(dst_topology, '*.gro'))
-    top_list = glob.glob(os.path.join(dst_topology, '*.top'))
+    # A single scandir pass over the input directory yields both the files to stage
+    # and the GRO/TOP candidates, instead of an os.listdir walk plus two glob scans.
+    with os.scandir(args.input_dir) as it:
+        filenames = [entry.name for entry in it if entry.is_file()]
+    gro_list = [os.path.join(dst_topology, f) for f in filenames if f.endswith('.gro')]
+    top_list = [os.path.join(dst_topology, f) for f in filenames if f.endswith('.top')]
     assert len(gro_list) == 1, "There should be exactly one GRO file in the input directory."
     assert len(top_list) == 1, "There should be exactly one TOP file in the input directory."
 
+    # Stage files from input_preparation/gmx_inputs into topology; the loop is purely
+    # I/O-bound, so the files are staged in parallel.
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(
+            lambda f: _stage_file(os.path.join(args.input_dir, f), os.path.join(dst_topology, f)),
+            filenames
+        ))
+
     input_gro = gro_list[0]
     input_top = top_list[0]
     cmd_list = []
 
+    # Parallelism flags for gmx mdrun; when OMP_NUM_THREADS is set, default to
+    # -ntomp $OMP_NUM_THREADS -pin on instead of GROMACS's auto-detection, which
+    # often picks poor thread splits on shared cluster nodes.
+    ntomp = args.ntomp if args.ntomp else os.environ.get('OMP_NUM_THREADS')
+    pin = args.pin if args.pin else ('on' if ntomp else None)
+    mdrun_flags = []
+    if args.ntmpi:
+        mdrun_flags.extend(['-ntmpi', str(args.ntmpi)])
+    if ntomp:
+        mdrun_flags.extend(['-ntomp', str(ntomp)])
+    if pin:
+        mdrun_flags.extend(['-pin', pin])
+    if args.gpu_id:
+        mdrun_flags.extend(['-gpu_id', args.gpu_id])
+
+    # On a rerun of the same inputs, box_volume and total_charge can be reused from
+    # the cache, which skips the editconf and first grompp invocations below.
+    cache_key = f'{_sha256(input_gro)}:{_sha256(input_top)}:{os.path.getmtime(mdp_dir)}'
+    cached = _load_prep_cache(cache_key)
+
     print("\n1. Simulation box creation")
     print("==========================")
-    gmx_args = [
-        'gmx', 'editconf',
-        '-f', input_gro,
-        '-o', os.path.join('box', 'box.gro'),
-        '-bt', 'cubic',
-        '-d', '1.0',
-        '-c'
-    ]
-    print(f'\nRunning command: {" ".join(gmx_args)}')
-    cmd_list.append(' '.join(gmx_args))
-    returncode, stdout = gmx_utils.run_gmx_cmd(gmx_args)
-    box_volume = float(stdout.split(':')[-1].split()[0])
+    box_gro = os.path.join('box', 'box.gro')
+    if cached is not None and os.path.isfile(box_gro) and _output_fingerprint(box_gro) == cached.get('box_gro'):
+        box_volume = cached['box_volume']
+        print(f'\nFound cached results for the same inputs. Skipping gmx editconf (box volume: {box_volume} nm^3).')
+    else:
+        gmx_args = [
+            'gmx', 'editconf',
+            '-f', input_gro,
+            '-o', os.path.join('box', 'box.gro'),
+            '-bt', 'cubic',
+            '-d', '1.0',
+            '-c'
+        ]
+        print('\nRunning command:', *gmx_args)
+        cmd_list.append(' '.join(gmx_args))
+        returncode, stdout = gmx_utils.run_gmx_cmd(gmx_args)
+        box_volume = float(stdout.split(':')[-1].split()[0])
 
     print("2. Solvation")
     print("============")
@@ -106,29 +297,40 @@ def main():
         '-p', input_top,
         '-cs'
     ]
-    print(f'\nRunning command: {" ".join(gmx_args)}')
+    print('\nRunning command:', *gmx_args)
     cmd_list.append(' '.join(gmx_args))
     returncode, stdout = gmx_utils.run_gmx_cmd(gmx_args)
 
     print("3. Neutralization with ions")
     print("============================")
-    gmx_args = [
-        'gmx', 'grompp',
-        '-f', os.path.join(mdp_dir, 'ions.mdp'),
-        '-c', os.path.join('solv_ions', 'solv.gro'),
-        '-p', input_top,
-        '-o', os.path.join('solv_ions', 'ions.tpr'),
-        '-po', os.path.join('solv_ions', 'mdout.mdp'),
-        '-maxwarn', '1'
-    ]
-    print(f'\nRunning command 1: {" ".join(gmx_args)}')
-    cmd_list.append(' '.join(gmx_args))
-    returncode, stdout = gmx_utils.run_gmx_cmd(gmx_args)
+    ions_tpr = os.path.join('solv_ions', 'ions.tpr')
+    if cached is not None and os.path.isfile(ions_tpr) and _output_fingerprint(ions_tpr) == cached.get('ions_tpr'):
+        total_charge = cached['total_charge']
+        print(f'\nFound cached results for the same inputs. Skipping gmx grompp (total charge: {total_charge}).')
+    else:
+        gmx_args = [
+            'gmx', 'grompp',
+            '-f', os.path.join(mdp_dir, 'ions.mdp'),
+            '-c', os.path.join('solv_ions', 'solv.gro'),
+            '-p', input_top,
+            '-o', os.path.join('solv_ions', 'ions.tpr'),
+            '-po', os.path.join('solv_ions', 'mdout.mdp'),
+            '-maxwarn', '1'
+        ]
+        print('\nRunning command 1:', *gmx_args)
+        cmd_list.append(' '.join(gmx_args))
+        returncode, stdout, charge_line = gmx_utils.run_gmx_cmd(
+            gmx_args,
+            match=lambda line: "System has non-zero total charge:" in line
+        )
+        total_charge = float(charge_line.split(":")[-1])
 
-    for line in stdout.splitlines():
-        if "System has non-zero total charge:" in line:
-            total_charge = float(line.split(":")[-1])
-            break
+        _save_prep_cache(cache_key, {
+            'box_volume': box_volume,
+            'total_charge': total_charge,
+            'box_gro': _output_fingerprint(box_gro),
+            'ions_tpr': _output_fingerprint(ions_tpr),
+        })
 
     n_ions = int(math.ceil(box_volume * 1E-27 * 1000 * 0.15 * 6.022E23))
     if total_charge < 0:
@@ -148,7 +350,7 @@ def main():
         '-np', str(n_sodium),
         '-nn', str(n_chloride),
     ]
-    print(f'\nRunning command 2: {" ".join(gmx_args)}')
+    print('\nRunning command 2:', *gmx_args)
     cmd_list.append(' '.join(gmx_args))
     returncode, stdout = gmx_utils.run_gmx_cmd(gmx_args, prompt_input='SOL\n')
 
@@ -163,12 +365,12 @@ def main():
         '-po', os.path.join('em', 'mdout.mdp'),
         '-maxwarn', '1'
     ]
-    print(f'\nRunning command 1: {" ".join(gmx_args)}')
+    print('\nRunning command 1:', *gmx_args)
     cmd_list.append(' '.join(gmx_args))
     returncode, stdout = gmx_utils.run_gmx_cmd(gmx_args)
 
-    gmx_args = ['gmx', 'mdrun', '-deffnm', 'em/em']
-    print(f'\nRunning command 2: {" ".join(gmx_args)}')
+    gmx_args = ['gmx', 'mdrun', '-deffnm', 'em/em'] + mdrun_flags
+    print('\nRunning command 2:', *gmx_args)
     cmd_list.append(' '.join(gmx_args))
     returncode, stdout = gmx_utils.run_gmx_cmd(gmx_args, prompt_input=None)
 
@@ -183,12 +385,12 @@ def main():
         '-po', os.path.join('equil', 'NVT', 'mdout.mdp'),
         '-maxwarn', '1'
     ]
-    print(f'\nRunning command 1: {" ".join(gmx_args)}')
+    print('\nRunning command 1:', *gmx_args)
     cmd_list.append(' '.join(gmx_args))
     returncode, stdout = gmx_utils.run_gmx_cmd(gmx_args)
 
-    gmx_args = ['gmx', 'mdrun', '-deffnm', 'equil/NVT/equil']
-    print(f'\nRunning command 2: {" ".join(gmx_args)}')
+    gmx_args = ['gmx', 'mdrun', '-deffnm', 'equil/NVT/equil'] + mdrun_flags
+    print('\nRunning command 2:', *gmx_args)
     cmd_list.append(' '.join(gmx_args))
     returncode, stdout = gmx_utils.run_gmx_cmd(gmx_args, prompt_input=None)
 
@@ -203,12 +405,12 @@ def main():
         '-po', os.path.join('equil', 'NPT', 'mdout.mdp'),
         '-maxwarn', '2'
     ]
-    print(f'\nRunning command 1: {" ".join(gmx_args)}')
+    print('\nRunning command 1:', *gmx_args)
     cmd_list.append(' '.join(gmx_args))
     returncode, stdout = gmx_utils.run_gmx_cmd(gmx_args)
 
-    gmx_args = ['gmx', 'mdrun', '-deffnm', 'equil/NPT/equil']
-    print(f'\nRunning command 2: {" ".join(gmx_args)}')
+    gmx_args = ['gmx', 'mdrun', '-deffnm', 'equil/NPT/equil'] + mdrun_flags
+    print('\nRunning command 2:', *gmx_args)
     cmd_list.append(' '.join(gmx_args))
     returncode, stdout = gmx_utils.run_gmx_cmd(gmx_args, prompt_input=None)
 
@@ -229,7 +431,7 @@ def main():
                 '-po', os.path.join(dst_prod, 'mdout.mdp'),
                 '-maxwarn', '1'
             ]
-            print(f'\nRunning command for replicate {rep}: {" ".join(gmx_args)}')
+            print(f'\nRunning command for replicate {rep}:', *gmx_args)
             cmd_list.append(' '.join(gmx_args))
             returncode, stdout = gmx_utils.run_gmx_cmd(gmx_args)
     else:
@@ -243,7 +445,7 @@ def main():
             '-po', os.path.join('production', 'mdout.mdp'),
             '-maxwarn', '1'
         ]
-        print(f'\nRunning command: {" ".join(gmx_args)}')
+        print('\nRunning command:', *gmx_args)
         cmd_list.append(' '.join(gmx_args))
         returncode, stdout = gmx_utils.run_gmx_cmd(gmx_args)
 
@@ -2,8 +2,12 @@ import os
 import sys
 import time
 import argparse
+import threading
+import subprocess
+from collections import deque
 from general_utils import utils
 from md_utils.simulation import gmx_utils
+from md_utils.utils import Logger
 
 
 def initialize(args):
@@ -57,17 +61,87 @@ def initialize(args):
     return args
 
 
+def _run_piped_trjconv(gmx_args_1, gmx_args_2, prompt_input_1, prompt_input_2):
+    """
+    Run two trjconv stages concurrently, connected through a named pipe.
+
+    Both processes must be alive at the same time for the pipe to flow, so each
+    one's output is drained in its own thread. The two stages are monitored
+    symmetrically: when either one exits nonzero while the other is still running,
+    the survivor is killed, since it would otherwise block forever on the abandoned
+    pipe (the upstream stage writing to it, or the downstream stage stuck opening
+    a FIFO that will never get a writer).
+
+    Parameters
+    ----------
+    gmx_args_1 : list
+        The upstream trjconv command, writing to the named pipe.
+    gmx_args_2 : list
+        The downstream trjconv command, reading from the named pipe.
+    prompt_input_1 : str
+        Index group selections for the upstream command.
+    prompt_input_2 : str
+        Index group selections for the downstream command.
+    """
+    procs, buffers, threads = [], [], []
+    for gmx_args, prompt_input in [(gmx_args_1, prompt_input_1), (gmx_args_2, prompt_input_2)]:
+        p = subprocess.Popen(
+            gmx_args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            stdin=subprocess.PIPE,
+            text=True,
+            bufsize=1
+        )
+        gmx_utils.feed_stdin(p, prompt_input)
+
+        lines = deque(maxlen=4096)
+
+        def drain(proc=p, buf=lines):
+            for line in proc.stdout:
+                buf.append(line)
+                sys.stdout.write(line)
+
+        thread = threading.Thread(target=drain, daemon=True)
+        thread.start()
+        procs.append(p)
+        buffers.append(lines)
+        threads.append(thread)
+
+    killed = [False, False]
+    while any(p.poll() is None for p in procs):
+        for i, other in [(0, 1), (1, 0)]:
+            if procs[i].poll() is not None and procs[i].returncode != 0 and procs[other].poll() is None:
+                procs[other].kill()
+                killed[other] = True
+        time.sleep(0.1)
+
+    for thread in threads:
+        thread.join()
+
+    # Report only the stage that failed on its own; a stage killed by us is just a
+    # consequence of the other one failing.
+    if procs[1].returncode != 0 and not killed[1]:
+        raise RuntimeError(
+            f'{" ".join(gmx_args_2[:2])} failed with return code {procs[1].returncode}:\n{"".join(buffers[1])}'
+        )
+    if procs[0].returncode != 0 and not killed[0]:
+        raise RuntimeError(
+            f'{" ".join(gmx_args_1[:2])} failed with return code {procs[0].returncode}:\n{"".join(buffers[0])}'
+        )
+
+
 def main():
     t1 = time.time()
     args = initialize(sys.argv[1:])
-    sys.stdout = utils.Logger(args.log)
-    sys.stderr = utils.Logger(args.log)
+    sys.stdout = Logger(args.log, sys.__stdout__)
+    sys.stderr = Logger(args.log, sys.__stderr__)
 
     print(f"\nCommand line: {' '.join(sys.argv)}")
     print(f"Current working directory: {os.getcwd()}")
 
-    # Test GROMACS installation
-    gmx_utils.run_gmx_cmd(['gmx', '--version'], print_output=False)
+    # Test GROMACS installation (skipped if already checked in this environment)
+    gmx_utils.ensure_gmx()
 
     input_traj = args.input
     prefix = input_traj.rsplit('.', 1)[0]
@@ -77,26 +151,24 @@ def main():
     cmd_list = []
 
     # Step 1: Recenter and remove jumps
-    gmx_args = [
+    nojump_traj = f'{prefix}_nojump.xtc'
+    gmx_args_1 = [
         'gmx', 'trjconv',
         '-s', tpr_file,
         '-f', input_traj,
-        '-o', f'{prefix}_nojump.xtc',
+        '-o', nojump_traj,
         '-center',
         '-pbc', 'nojump'
     ]
 
     if args.time_step:
-        gmx_args.extend(['-dt', str(args.time_step)])
-
-    print(f'\nRunning command: {" ".join(gmx_args)}')
-    cmd_list.append(' '.join(gmx_args))
-    returncode, stdout = gmx_utils.run_gmx_cmd(gmx_args, prompt_input=f'{grps[0]}\n{grps[1]}\n')
+        gmx_args_1.extend(['-dt', str(args.time_step)])
 
-    gmx_args = [
+    # Step 2: Rewrap molecules into a compact unit cell
+    gmx_args_2 = [
         'gmx', 'trjconv',
         '-s', tpr_file,
-        '-f', f'{prefix}_nojump.xtc',
+        '-f', nojump_traj,
         '-o', output_traj,
         '-center',
         '-pbc', 'whole',
@@ -104,11 +176,38 @@ def main():
     ]
 
     if args.time_step:
-        gmx_args.extend(['-dt', str(args.time_step)])
+        gmx_args_2.extend(['-dt', str(args.time_step)])
+
+    # Where named pipes are available, connect the two stages through a FIFO so the
+    # intermediate trajectory is streamed between them instead of being written to
+    # disk and read back, which halves the trajectory-sized disk bandwidth.
+    try:
+        if os.path.lexists(nojump_traj):
+            os.unlink(nojump_traj)
+        os.mkfifo(nojump_traj)
+        use_fifo = True
+    except (AttributeError, OSError):
+        use_fifo = False
+
+    if use_fifo:
+        # GROMACS's automatic output backup would open the pre-made FIFO for reading
+        # (blocking with no writer attached) and then rename it away, so backups must
+        # be disabled for the stage that writes to the pipe.
+        gmx_args_1.append('-nobackup')
+
+    print('\nRunning command:', *gmx_args_1)
+    cmd_list.append(' '.join(gmx_args_1))
+    print('\nRunning command:', *gmx_args_2)
+    cmd_list.append(' '.join(gmx_args_2))
 
-    print(f'\nRunning command: {" ".join(gmx_args)}')
-    cmd_list.append(' '.join(gmx_args))
-    returncode, stdout = gmx_utils.run_gmx_cmd(gmx_args, prompt_input=f'{grps[2]}\n{grps[3]}\n')
+    if use_fifo:
+        try:
+            _run_piped_trjconv(gmx_args_1, gmx_args_2, f'{grps[0]}\n{grps[1]}\n', f'{grps[2]}\n{grps[3]}\n')
+        finally:
+            os.unlink(nojump_traj)
+    else:
+        returncode, stdout = gmx_utils.run_gmx_cmd(gmx_args_1, prompt_input=f'{grps[0]}\n{grps[1]}\n')
+        returncode, stdout = gmx_utils.run_gmx_cmd(gmx_args_2, prompt_input=f'{grps[2]}\n{grps[3]}\n')
 
     print("Summary of commands executed:")
     for cmd in cmd_list:
@@ -1,25 +1,119 @@
+import os
+import sys
+import threading
 import subprocess
+from collections import deque
 
+_gmx_checked = False
 
-def run_gmx_cmd(arguments, prompt_input=None, print_output=True):
-    try:
-        result = subprocess.run(
-            arguments,
-            stdout=subprocess.PIPE,    # Capture stdout
-            stderr=subprocess.STDOUT,  # Redirect stderr to stdout
-            text=True,                 # Return strings instead of bytes
-            input=prompt_input,
-            check=True                 # Raise exception on non-zero exit
-        )
-        returncode, stdout = result.returncode, result.stdout
-    except subprocess.CalledProcessError as e:
-        # e.output contains the full error message (thanks to stderr=STDOUT)
-        returncode, stdout = e.returncode, e.output
+
+def ensure_gmx():
+    """
+    Check that GROMACS is installed, at most once per process.
+
+    gmx startup does MPI/thread/GPU detection and can take seconds on clusters, so
+    the probe result is cached in a module-level flag and in the GMX_VERSION_CHECKED
+    environment variable, which also lets child processes and subsequent tools in
+    the same environment skip the probe entirely.
+    """
+    global _gmx_checked
+    if _gmx_checked or os.environ.get('GMX_VERSION_CHECKED'):
+        return
+    run_gmx_cmd(['gmx', '--version'], print_output=False)
+    _gmx_checked = True
+    os.environ['GMX_VERSION_CHECKED'] = '1'
+
+
+def feed_stdin(p, prompt_input):
+    """
+    Feed input to a child process's stdin from a daemon thread.
+
+    Writing from the main thread can deadlock: if the child fills its stdout pipe
+    before reading all of its stdin, both sides block. Writing from a separate
+    thread lets the caller drain stdout concurrently. A broken pipe is ignored,
+    like subprocess.run does: it just means the child exited (or never read stdin)
+    before consuming the input, and the exit status is reported by the caller.
+
+    Parameters
+    ----------
+    p : subprocess.Popen
+        The child process. Its stdin is closed after the input is written.
+    prompt_input : str or None
+        Input to write to the child's stdin, e.g. index group selections.
+    """
+    def feed():
+        try:
+            if prompt_input is not None:
+                p.stdin.write(prompt_input)
+            p.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+
+    threading.Thread(target=feed, daemon=True).start()
+
+
+def run_gmx_cmd(arguments, prompt_input=None, print_output=True, match=None):
+    """
+    Run a GROMACS command and stream its output line by line.
+
+    Instead of buffering the entire log in memory before printing (which delays output
+    by minutes for long mdrun calls and doubles memory usage), the child's stdout is
+    read as lines are produced and written to the current stdout immediately. A bounded
+    ring buffer keeps the most recent lines for error reporting and the returned log.
+
+    Parameters
+    ----------
+    arguments : list
+        The GROMACS command to run, as a list of arguments.
+    prompt_input : str, optional
+        Input to feed to the command's stdin, e.g. index group selections.
+    print_output : bool, optional
+        Whether to print the command output as it is produced. The default is True.
+    match : callable, optional
+        A callable that takes one line of output and returns True for the line of
+        interest. When provided, the first matching line is returned as a third
+        element of the return tuple, so callers can pick a line out of the stream
+        without splitting the full log afterwards.
+
+    Returns
+    -------
+    returncode : int
+        The return code of the command.
+    stdout : str
+        The combined stdout/stderr of the command. For very long logs, only the most
+        recent lines are retained.
+    matched : str or None
+        The first line for which :code:`match` returned True, or None if no line
+        matched. Only returned when :code:`match` is provided.
+    """
+    p = subprocess.Popen(
+        arguments,
+        stdout=subprocess.PIPE,    # Capture stdout
+        stderr=subprocess.STDOUT,  # Redirect stderr to stdout
+        stdin=subprocess.PIPE,
+        text=True,                 # Return strings instead of bytes
+        bufsize=1                  # Line-buffered
+    )
+
+    feed_stdin(p, prompt_input)
+
+    # Keep only the most recent lines so memory stays constant for long mdrun logs.
+    lines = deque(maxlen=4096)
+    matched = None
+    for line in p.stdout:
+        lines.append(line)
+        if match is not None and matched is None and match(line):
+            matched = line
+        if print_output:
+            sys.stdout.write(line)
+
+    returncode = p.wait()
+    stdout = ''.join(lines)
 
     if returncode != 0:
         raise RuntimeError(f'{" ".join(arguments[:2])} failed with return code {returncode}:\n{stdout}')
-    else:
-        if print_output:
-            print(f"\n{stdout}")
+
+    if match is not None:
+        return returncode, stdout, matched
 
     return returncode, stdout
@@ -0,0 +1,49 @@
+import io
+import sys
+import threading
+
+
+class Logger:
+    """
+    A logger that redirects output to both the terminal and a log file.
+
+    The log file is opened once with a 1 MiB write buffer, and messages are first
+    accumulated in an in-memory buffer that is only flushed to the file when it grows
+    beyond 64 KiB or a section banner (a line of "=") is written. This avoids one
+    write() syscall per print call, which matters when a long gmx mdrun produces
+    millions of lines. Writes and flushes are serialized with a lock, since the
+    logger may be written to from several threads at once (e.g. the drain threads
+    of the trjconv pipeline in process_gmx_traj).
+
+    Parameters
+    ----------
+    logfile : str
+        Path to the log file. Output is appended to the file if it already exists.
+    stream : file-like, optional
+        The original stream to tee to, e.g. sys.__stdout__ or sys.__stderr__. The
+        default is the interpreter's original stdout. Pass the original stream
+        explicitly when replacing sys.stderr; otherwise the already-replaced
+        sys.stdout would be captured and every message would land in the log twice.
+    """
+
+    flush_threshold = 64 * 1024  # 64 KiB
+
+    def __init__(self, logfile, stream=None):
+        self.terminal = stream if stream is not None else sys.__stdout__
+        self.file = open(logfile, 'a', buffering=1024 * 1024, encoding='utf-8')
+        self.buffer = io.StringIO()
+        self.lock = threading.RLock()
+
+    def write(self, message):
+        with self.lock:
+            self.terminal.write(message)
+            self.buffer.write(message)
+            if self.buffer.tell() >= self.flush_threshold or '=====' in message:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            self.file.write(self.buffer.getvalue())
+            self.buffer = io.StringIO()
+            self.file.flush()
+            self.terminal.flush()